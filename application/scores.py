@@ -36,10 +36,7 @@ divider = '------------------------------'
 
 
 def explode_img(img, num_classes=6):
-    exploded = np.zeros(shape=img.shape + (num_classes,), dtype=np.uint8)
-    for i in range(num_classes):
-        exploded[:, :, i] = (img[:, :] == i).astype(np.uint8)
-    return exploded
+    return np.eye(num_classes, dtype=np.uint8)[img]
 
 
 def prepare_prediction(pred):
@@ -61,8 +58,9 @@ def specificity_single(pred, true):
 
 
 def dice_single(pred, true):
-    intersection = np.sum(pred * true)
-    union = np.sum(pred + true)
+    # masks are binary: count set pixels instead of summing products upcast to int64
+    intersection = np.count_nonzero(np.logical_and(pred, true))
+    union = np.count_nonzero(pred) + np.count_nonzero(true)
     return (2 * intersection + 1) / (union + 1)
 
 
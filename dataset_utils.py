@@ -29,6 +29,7 @@ import sys
 import random
 import shutil
 import numpy as np
+import tensorflow as tf
 from tensorflow import keras
 from tensorflow.keras.preprocessing.image import load_img, img_to_array
 
@@ -38,6 +39,7 @@ input_dir = "build/dataset/input"
 extension = ".npy"
 
 cal_samples = 500
+cal_subset = None  # if set, only this many images of the calibration set are used, picked to cover every class
 
 input_img_paths = sorted(
     [
@@ -109,10 +111,31 @@ def explode_img(img, num_classes, img_size):
     @return: A binary n by n by num_classes volume where img[:, :, class_i] is equal to 1 where pixel of the i-th
     class are present
     """
-    exploded = np.zeros(shape=img_size + (num_classes,), dtype=np.uint8)
-    for i in range(num_classes):
-        exploded[:, :, i] = (img[:, :] == i).astype(np.uint8)
-    return exploded
+    assert img.shape == img_size
+    return np.eye(num_classes, dtype=np.uint8)[img]
+
+
+def stratified_indices(target_paths, num_samples, num_classes=6):
+    """
+    Pick a subset of images such that every class is represented as evenly as possible
+    @param target_paths: paths of the labels to choose from
+    @param num_samples: number of images to pick
+    @param num_classes: the number of labels present in the dataset
+    @return: sorted indices of the picked images
+    """
+    presence = [np.bincount(np.load(path).ravel(), minlength=num_classes) > 0 for path in target_paths]
+    # one queue of candidates for each organ, plus a last one with every image to fill the remaining places
+    queues = [[i for i, present in enumerate(presence) if present[c]] for c in range(1, num_classes)]
+    queues.append(list(range(len(target_paths))))
+    picked = set()
+    num_samples = min(num_samples, len(target_paths))
+    while len(picked) < num_samples:
+        for queue in queues:  # round robin between organs
+            while queue and queue[0] in picked:
+                queue.pop(0)
+            if queue and len(picked) < num_samples:
+                picked.add(queue.pop(0))
+    return sorted(picked)
 
 
 class DataGen(keras.utils.Sequence):
@@ -165,11 +188,39 @@ def get_DataGen(dataset="train", batch_size=64, img_size=(256, 256)):
     elif dataset == "calibration":
         cal_input_img_paths = input_img_paths[-cal_samples:]
         cal_target_img_paths = target_img_paths[-cal_samples:]
+        if cal_subset is not None and cal_subset < cal_samples:
+            indices = stratified_indices(cal_target_img_paths, cal_subset)
+            cal_input_img_paths = [cal_input_img_paths[i] for i in indices]
+            cal_target_img_paths = [cal_target_img_paths[i] for i in indices]
         return DataGen(batch_size, img_size, cal_input_img_paths, cal_target_img_paths)
     else:
         raise ValueError('dataset should be equal to "train", "validation", "calibration", or "test"')
 
 
+def get_Dataset(dataset="train", batch_size=64, img_size=(256, 256), input_dtype=tf.float32):
+    """
+    Return the same batches of get_DataGen as a tf.data pipeline: batches are loaded from disk by parallel calls and
+    prefetched, so that the next ones are ready while the current one is being processed
+    @param dataset: "train", "validation", "calibration", or "test"
+    @param batch_size: number of images per batch. Default is 64
+    @param img_size: dimension of a single image. Default (256, 256)
+    @param input_dtype: type the input images are cast to on the host, e.g. tf.float16 to halve the bytes copied to
+    the device. Default tf.float32
+    @return: a tf.data.Dataset yielding (input, target) batches
+    """
+    datagen = get_DataGen(dataset=dataset, batch_size=batch_size, img_size=img_size)
+
+    def load_batch(idx):
+        x, y = tf.numpy_function(datagen.__getitem__, [idx], (tf.float32, tf.uint8))
+        x.set_shape((batch_size,) + img_size + (1,))
+        y.set_shape((batch_size,) + img_size + (datagen.num_classes,))
+        return tf.cast(x, input_dtype), y
+
+    return tf.data.Dataset.range(len(datagen)) \
+        .map(load_batch, num_parallel_calls=tf.data.experimental.AUTOTUNE) \
+        .prefetch(tf.data.experimental.AUTOTUNE)
+
+
 def prepare_target_images(start=0, num_images=1000):
     """
     Prepare directory with input and labels for evaluation on the board
@@ -21,13 +21,15 @@
 # SOFTWARE.
 
 import argparse
+import os
+import tempfile
 import time
 
+import numpy as np
 import tensorflow as tf
 import sys
 
-import dataset_utils
-from dataset_utils import get_DataGen, get_train_len
+from dataset_utils import get_Dataset, get_train_len
 from tensorflow.keras.models import load_model
 from scores_losses import foc_tversky_loss, dice, dice_liver, dice_bladder, dice_lungs, \
     dice_kidneys, dice_bones
@@ -48,9 +50,29 @@ if gpus:
         # Virtual devices must be set before GPUs have been initialized
         print(e)
 
+# enable XLA auto-clustering
+tf.config.optimizer.set_jit(True)
+
 DIVIDER = '-----------------------------------------'
 
 
+def mixed_precision_model(model):
+    """
+    Rebuild a float model with the 'mixed_float16' policy: convolutions run in FP16 with FP32 variables and
+    accumulations. Layers of a loaded model keep the float32 dtype they were saved with, so setting the global policy
+    before load_model is not enough. Output layers stay in float32 to keep the softmax numerically stable
+    """
+    config = model.get_config()
+    output_layers = [output[0] for output in config['output_layers']]
+    for layer in config['layers']:
+        if layer['class_name'] != 'InputLayer' and layer['name'] not in output_layers:
+            # serialized policy: TF 2.3 layers do not accept a policy name string as dtype
+            layer['config']['dtype'] = {'class_name': 'Policy', 'config': {'name': 'mixed_float16'}}
+    mixed_model = tf.keras.Model.from_config(config)
+    mixed_model.set_weights(model.get_weights())
+    return mixed_model
+
+
 def main():
     """Evaluate float model results using the same metrics adopted for FPGA evaluation (keras evaluate model is
     cannot be used on the FPGA) """
@@ -59,6 +81,11 @@ def main():
                     help='Full path of model to evaluate. Default is build/float_model/f_model.h5')
     ap.add_argument('-b', '--batchsize', type=int, default=8, help='Batchsize for quantization. Default is 8')
     ap.add_argument('-d', '--imgsize', type=int, default=256, help='Dimension for data generator. Default is 256')
+    ap.add_argument('-mp', '--mixedprecision', action='store_true',
+                    help='Run the dice evaluation inference with mixed FP16/FP32 precision. Default is False')
+    ap.add_argument('-p', '--predictions', type=str, default=None,
+                    help='Full path of the file where the FP16 predictions are streamed and kept. Default is a '
+                         'temporary file in build/, removed after the evaluation')
     args = ap.parse_args()
 
     print('\n------------------------------------')
@@ -66,9 +93,11 @@ def main():
     print(sys.version)
     print('------------------------------------')
     print('Command line options:')
-    print(' --model        : ', args.model)
-    print(' --batchsize    : ', args.batchsize)
-    print(' --imgsize      : ', args.imgsize)
+    print(' --model          : ', args.model)
+    print(' --batchsize      : ', args.batchsize)
+    print(' --imgsize        : ', args.imgsize)
+    print(' --mixedprecision : ', args.mixedprecision)
+    print(' --predictions    : ', args.predictions)
     print('------------------------------------\n')
 
     model = load_model(args.model, custom_objects={'foc_tversky_loss': foc_tversky_loss, 'dice': dice,
@@ -78,22 +107,37 @@ def main():
                                                    'dice_kidneys': dice_kidneys,
                                                    'dice_bones': dice_bones})
 
-    datagen = get_DataGen(dataset="test", batch_size=args.batchsize, img_size=(args.imgsize, args.imgsize))
-    
-    model.evaluate(datagen)
+    infer_model = mixed_precision_model(model) if args.mixedprecision else model
+
+    # traced once for every batch, without the per-call overhead of Keras predict. Slices are moved to the device in
+    # FP16 and cast back there
+    infer = tf.function(lambda x: infer_model(tf.cast(x, tf.float32), training=False),
+                        input_signature=[tf.TensorSpec([None, args.imgsize, args.imgsize, 1], tf.float16)])
+
+    dataset = get_Dataset(dataset="test", batch_size=args.batchsize, img_size=(args.imgsize, args.imgsize),
+                          input_dtype=tf.float16)
 
-    preds = []
-    true = []
-    for i in range(dataset_utils.get_train_len() // args.batchsize):
-        x, y = datagen.__getitem__(i)
-        predictions = model.predict(x)
-        for j in range(args.batchsize):
-            preds.append(predictions[j])
-            true.append(y[j])
+    model.evaluate(dataset)
 
-    assert len(preds) == len(true)
+    # a single pass over the prefetched dataset: the next batch is loaded while the current one is predicted.
+    # Predictions (FP16) and labels are streamed to memory-mapped .npy files, so that memory does not grow with the
+    # dataset. The temporary directory is on disk in build/, as /tmp may be RAM-backed
+    num_samples = (get_train_len() // args.batchsize) * args.batchsize
+    with tempfile.TemporaryDirectory(dir='build') as tmp_dir:
+        preds_path = args.predictions or os.path.join(tmp_dir, 'predictions.npy')
+        true_path = os.path.join(tmp_dir, 'labels.npy')
+        preds = np.lib.format.open_memmap(preds_path, mode='w+', dtype=np.float16,
+                                          shape=(num_samples, args.imgsize, args.imgsize, 6))
+        true = np.lib.format.open_memmap(true_path, mode='w+', dtype=np.uint8,
+                                         shape=(num_samples, args.imgsize, args.imgsize, 6))
+        for i, (x, y) in enumerate(dataset):
+            preds[i * args.batchsize:(i + 1) * args.batchsize] = tf.cast(infer(x), tf.float16).numpy()
+            true[i * args.batchsize:(i + 1) * args.batchsize] = y.numpy()
+        preds.flush()
+        true.flush()
+        del preds, true
 
-    evaluate_results(preds, true)
+        evaluate_results(np.load(preds_path, mmap_mode='r'), np.load(true_path, mmap_mode='r'))
 
 
 if __name__ == "__main__":
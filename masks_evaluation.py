@@ -21,125 +21,80 @@
 # SOFTWARE.
 
 import numpy as np
-
-# counters for organs frequencies
-n_liver = 0
-n_bladder = 0
-n_lungs = 0
-n_kidneys = 0
-n_bones = 0
+from numba import njit, prange
 
 divider = '------------------------------'
 
 
-def explode_img(img, num_classes=6):
-    exploded = np.zeros(shape=img.shape + (num_classes,), dtype=np.uint8)
-    for i in range(num_classes):
-        exploded[:, :, i] = (img[:, :] == i).astype(np.uint8)
-    return exploded
-
-
-def prepare_prediction(pred):
+@njit(cache=True, parallel=True, fastmath=True)
+def dice_batch(preds, true, intersection, union, weights):
     """
-    Transform the 3D U-Net output into a 2D image
-    @param pred: U-Net prediction output
-    @return: a "visualizable" 2D segmentation
+    Compute the dice terms of each label for a batch of slices straight from the U-Net output, fusing the argmax and
+    the counting in a single pass over the pixels. Slices are processed in parallel, each one writing its own row
+    @param preds: U-Net prediction outputs (N, H, W, num_classes)
+    @param true: binary label volumes (N, H, W, num_classes)
+    @param intersection: (N, num_classes) filled with the pixels correctly assigned to each label
+    @param union: (N, num_classes) filled with the predicted plus labelled pixels of each label
+    @param weights: (N, num_classes) filled with the labelled pixels of each label
     """
-    mask = np.argmax(pred, axis=-1)
-    mask = mask.astype('uint8')
-    return mask
-
-
-def dice_single(pred, true):
-    """ Compute the dice score of a 2D binary slice"""
-    intersection = np.sum(pred * true)
-    union = np.sum(pred + true)
-    return (2 * intersection + 1) / (union + 1)
-
-
-def dice_total(pred, true):
-    """ Compute the dice score of each label for a single slice"""
-    # true = explode_img(true)
-    dice_background = dice_single(pred == 0, true[:, :, 0])
-    dice_liver = dice_single(pred == 1, true[:, :, 1])
-    dice_bladder = dice_single(pred == 2, true[:, :, 2])
-    dice_lungs = dice_single(pred == 3, true[:, :, 3])
-    dice_kidneys = dice_single(pred == 4, true[:, :, 4])
-    dice_bones = dice_single(pred == 5, true[:, :, 5])
-
-    background_w = np.sum(true[:, :, 0])
-    liver_w = np.sum(true[:, :, 1])
-    bladder_w = np.sum(true[:, :, 2])
-    lungs_w = np.sum(true[:, :, 3])
-    kidneys_w = np.sum(true[:, :, 4])
-    bones_w = np.sum(true[:, :, 5])
-
-    global n_liver
-    n_liver += liver_w
-    global n_bladder
-    n_bladder += bladder_w
-    global n_lungs
-    n_lungs += lungs_w
-    global n_kidneys
-    n_kidneys += kidneys_w
-    global n_bones
-    n_bones += bones_w
-
-    return ((liver_w * dice_liver + bladder_w * dice_bladder + lungs_w * dice_lungs +
-             kidneys_w * dice_kidneys + bones_w * dice_bones + 1) / (liver_w + bladder_w + lungs_w + kidneys_w +
-                                                                     bones_w + 1)), \
-           dice_liver * liver_w, dice_bladder * bladder_w, dice_lungs * lungs_w, dice_kidneys * kidneys_w, \
-           dice_bones * bones_w
+    num_slices, height, width, num_classes = preds.shape
+    for n in prange(num_slices):
+        intersection[n] = 0
+        union[n] = 0
+        weights[n] = 0
+        for i in range(height):
+            for j in range(width):
+                best = 0
+                best_value = preds[n, i, j, 0]
+                for c in range(1, num_classes):
+                    if preds[n, i, j, c] > best_value:
+                        best_value = preds[n, i, j, c]
+                        best = c
+                union[n, best] += 1
+                intersection[n, best] += true[n, i, j, best]
+                for c in range(num_classes):
+                    weights[n, c] += true[n, i, j, c]
+        union[n] += weights[n]
+
+
+def dice_scores(intersection, union, weights):
+    """
+    Compute the dice scores of one or more slices from their dice terms
+    @return: the organs dice weighted by organs frequency, the dice of each organ and the frequency of each organ.
+    Background is excluded from the organs
+    """
+    organs_dices = ((2 * intersection + 1) / (union + 1))[..., 1:]
+    organs_w = weights[..., 1:]
+    return (np.sum(organs_w * organs_dices, axis=-1) + 1) / (np.sum(organs_w, axis=-1) + 1), organs_dices, organs_w
 
 
-def evaluate_results(list_pred, list_true):
+def evaluate_results(preds, true, block_size=32):
     """Compute dice score of the whole dataset. Score is returned both as a 'single-slices scores
-    mean' and in a 'weighted by organs frequency mean'. Also single-organs score is returned."""
-    dices = []
-    dice = 0
-    dice_liver_total = []
-    dice_bladder_total = []
-    dice_lungs_total = []
-    dice_kidneys_total = []
-    dice_bones_total = []
-    for i in range(len(list_pred)):
-        pred = list_pred[i]
-        true = list_true[i]
-        pred = prepare_prediction(pred)
-        current_dice, dice_liver, dice_bladder, dice_lungs, dice_kidneys, dice_bones = dice_total(pred, true)
-
-        dice_liver_total.append(dice_liver)
-        dice_bladder_total.append(dice_bladder)
-        dice_lungs_total.append(dice_lungs)
-        dice_kidneys_total.append(dice_kidneys)
-        dice_bones_total.append(dice_bones)
-        dice += current_dice
-        dices.append(current_dice)
+    mean' and in a 'weighted by organs frequency mean'. Also single-organs score is returned.
+    Predictions and labels are read block_size slices at a time, so memory-mapped (and FP16 preds) arrays are never
+    loaded whole."""
+    intersection = np.empty((len(preds), true.shape[-1]), dtype=np.int64)
+    union = np.empty_like(intersection)
+    weights = np.empty_like(intersection)
+    for i in range(0, len(preds), block_size):
+        dice_batch(np.asarray(preds[i:i + block_size], dtype=np.float32), np.asarray(true[i:i + block_size]),
+                   intersection[i:i + block_size], union[i:i + block_size], weights[i:i + block_size])
+    # (N,) slices dices and (N, organs) dices and frequencies
+    dices, organs_dices, organs_w = dice_scores(intersection, union, weights)
+    organs_dices = organs_dices * organs_w
+    n_organs = np.sum(organs_w, axis=0)
 
     print(divider)
     print('Global Dice:')
     print("Mean on slices: %.2f +- %.2f" % (np.mean(dices) * 100, np.std(dices) * 100))
 
-    global n_liver
-    global n_bladder
-    global n_lungs
-    global n_kidneys
-    global n_bones
-
-    std_organs = ((np.std(dice_liver_total) + np.std(dice_bladder_total) + np.std(dice_lungs_total) +
-                   np.std(dice_kidneys_total) + np.std(dice_bones_total)) / (n_liver + n_bladder + n_lungs +
-                                                                             n_kidneys + n_bones))
+    std_organs = np.sum(np.std(organs_dices, axis=0)) / np.sum(n_organs)
     print('Weighted Mean on organs: %.2f +- %.2f' % (
-        (np.sum(dice_liver_total) + np.sum(dice_bladder_total) + np.sum(dice_lungs_total) + np.sum(dice_kidneys_total)
-         + np.sum(dice_bones_total)) / (n_liver + n_bladder + n_lungs + n_kidneys + n_bones) * 100, std_organs * 100))
+        np.sum(organs_dices) / np.sum(n_organs) * 100, std_organs * 100))
     print(divider)
 
     print('Organs Dices:')
-    print('Liver: %.2f +- %.2f' % (np.sum(dice_liver_total) / n_liver * 100, np.std(dice_liver_total) / n_liver * 100))
-    print('Bladder: %.2f +- %.2f' % (
-    np.sum(dice_bladder_total) / n_bladder * 100, np.std(dice_bladder_total) / n_bladder * 100))
-    print('Lungs: %.2f +- %.2f' % (np.sum(dice_lungs_total) / n_lungs * 100, np.std(dice_lungs_total) / n_lungs * 100))
-    print('Kidneys: %.2f +- %.2f' % (
-    np.sum(dice_kidneys_total) / n_kidneys * 100, np.std(dice_kidneys_total) / n_kidneys * 100))
-    print('Bones: %.2f +- %.2f' % (np.sum(dice_bones_total) / n_bones * 100, np.std(dice_bones_total) / n_bones * 100))
+    for organ, organ_dices, n_organ in zip(['Liver', 'Bladder', 'Lungs', 'Kidneys', 'Bones'], organs_dices.T,
+                                           n_organs):
+        print('%s: %.2f +- %.2f' % (organ, np.sum(organ_dices) / n_organ * 100, np.std(organ_dices) / n_organ * 100))
     print(divider)
@@ -37,7 +37,7 @@ from tensorflow.keras.optimizers import Adam
 
 from scores_losses import foc_tversky_loss, dice, dice_loss, dice_liver, dice_bladder, dice_lungs, \
     dice_kidneys, dice_bones
-from dataset_utils import get_DataGen
+from dataset_utils import get_Dataset
 from GPU_MEMORY import MAX_MEM
 
 gpus = tf.config.experimental.list_physical_devices('GPU')
@@ -54,6 +54,9 @@ if gpus:
         # Virtual devices must be set before GPUs have been initialized
         print(e)
 
+# enable XLA auto-clustering
+tf.config.optimizer.set_jit(True)
+
 DIVIDER = '-----------------------------------------'
 
 
@@ -86,7 +89,34 @@ def evaluate_model(model, dataset, quantized=False):
     print('\n' + DIVIDER)
 
 
-def quant_model(float_model, quant_model, batchsize, imgsize, evaluate, calibration_dimension, FFT, FFT_epochs):
+def export_tflite(model, tflite_model, dataset):
+    """
+    Convert the floating-point model into a fully INT8 TFLite model for CPU and edge devices without a DPU.
+    The TFLite converter calibrates the activations itself on the given dataset
+    """
+    print('\n' + DIVIDER)
+    print('Exporting TFLite model...')
+    print(DIVIDER + '\n')
+
+    def representative_dataset():
+        for x, _ in dataset:
+            yield [x]
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.representative_dataset = representative_dataset
+    converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    # integer input and output too, for integer-only runtimes
+    converter.inference_input_type = tf.int8
+    converter.inference_output_type = tf.int8
+
+    os.makedirs(os.path.dirname(tflite_model) or '.', exist_ok=True)
+    with open(tflite_model, 'wb') as f:
+        f.write(converter.convert())
+
+
+def quant_model(float_model, quant_model, batchsize, imgsize, evaluate, calibration_dimension, calibration_subset, FFT,
+                FFT_epochs, tflite_model=None):
     '''
     Quantize the floating-point model
     Save to HDF5 file
@@ -110,9 +140,12 @@ def quant_model(float_model, quant_model, batchsize, imgsize, evaluate, calibrat
     height = float_model.input_shape[1]
     width = float_model.input_shape[2]
 
-    # Instance of the dataset via keras.utils.Sequence
+    # Instance of the dataset via tf.data, so that calibration batches are loaded while the previous ones are processed
     dataset_utils.cal_samples = calibration_dimension  # set desired number of images for calibration dataset
-    quant_dataset = get_DataGen(dataset="calibration", batch_size=batchsize)
+    # PTQ only needs enough images to cover every organ activation range: calibrate on a stratified subset of them.
+    # FFT trains on the calibration dataset, so it keeps all of it
+    dataset_utils.cal_subset = None if FFT else calibration_subset
+    quant_dataset = get_Dataset(dataset="calibration", batch_size=batchsize)
 
     # run quantization
     quantizer = vitis_quantize.VitisQuantizer(float_model)
@@ -130,9 +163,15 @@ def quant_model(float_model, quant_model, batchsize, imgsize, evaluate, calibrat
     # saved quantized model
     quantized_model.save(quant_model)
 
+    if tflite_model is not None:
+        # the Vitis quantized layers cannot be converted: TFLite quantizes the float model on the same calibration set,
+        # fed with the batch size the model has been built with
+        export_tflite(float_model, tflite_model,
+                      get_Dataset(dataset="calibration", batch_size=float_model.input_shape[0] or 1))
+
     if evaluate:
         evaluate_model(quantized_model,
-                       get_DataGen(dataset="test", batch_size=batchsize, img_size=imgsize),
+                       get_Dataset(dataset="test", batch_size=batchsize, img_size=imgsize),
                        quantized=True)
 
     return
@@ -148,11 +187,17 @@ def main():
     ap.add_argument('-b', '--batchsize', type=int, default=8, help='Batchsize for quantization. Default is 8')
     ap.add_argument('-c', '--calibration', type=int, default=500, help='Dimension of the calibration dataset. Default '
                                                                        'is 500')
+    ap.add_argument('-cs', '--calibration_subset', type=int, default=150,
+                    help='Number of images of the calibration dataset used for PTQ, picked to cover every organ. '
+                         'Ignored with fast fine tuning. Default is 150')
     ap.add_argument('-fft', '--fastfinetuning', action='store_true',
                     help='Perform fast fine tuning. Use the --fftEpochs arg to set FFT epochs. Default is False')
     ap.add_argument('-ffte', '--fftepochs', type=int, default=10,
                     help='Set how many iteration are performed for each layer weights tuning. Default is 10')
     ap.add_argument('-d', '--imgsize', type=int, default=256, help='Dimension for data generator. Default is 256')
+    ap.add_argument('-tfl', '--tflite', type=str, default=None,
+                    help='Full path where to also save a fully INT8 TFLite model, e.g. build/quant_model/q_model.tflite. '
+                         'Default is no TFLite export')
     ap.add_argument('-e', '--evaluate', action='store_true',
                     help='Evaluate floating-point model if set. Default is no evaluation.')
     args = ap.parse_args()
@@ -162,18 +207,20 @@ def main():
     print(sys.version)
     print('------------------------------------')
     print('Command line options:')
-    print(' --float_model    : ', args.float_model)
-    print(' --quant_model    : ', args.quant_model)
-    print(' --batchsize      : ', args.batchsize)
-    print(' --calibration    : ', args.calibration)
-    print(' --fastfinetuning : ', args.fastfinetuning)
-    print(' --fftepochs      : ', args.fftepochs)
-    print(' --imgsize        : ', args.imgsize)
-    print(' --evaluate       : ', args.evaluate)
+    print(' --float_model        : ', args.float_model)
+    print(' --quant_model        : ', args.quant_model)
+    print(' --batchsize          : ', args.batchsize)
+    print(' --calibration        : ', args.calibration)
+    print(' --calibration_subset : ', args.calibration_subset)
+    print(' --fastfinetuning     : ', args.fastfinetuning)
+    print(' --fftepochs          : ', args.fftepochs)
+    print(' --imgsize            : ', args.imgsize)
+    print(' --tflite             : ', args.tflite)
+    print(' --evaluate           : ', args.evaluate)
     print('------------------------------------\n')
 
     quant_model(args.float_model, args.quant_model, args.batchsize, args.imgsize, args.evaluate, args.calibration,
-                args.fastfinetuning, args.fftepochs)
+                args.calibration_subset, args.fastfinetuning, args.fftepochs, args.tflite)
 
 
 if __name__ == "__main__":
@@ -31,48 +31,6 @@ smooth = 1
 alpha = 0.7
 
 
-# 0 background
-# 1 liver
-# 2 bladder
-# 3 lungs
-# 4 kidneys
-# 5 bone
-
-def tversky_liver(y_true, y_pred, num_channel=1):
-    true_pos = K.sum(y_true[:, :, :, num_channel] * y_pred[:, :, :, num_channel])
-    false_neg = K.sum(y_true[:, :, :, num_channel] * (1 - y_pred[:, :, :, num_channel]))
-    false_pos = K.sum((1 - y_true[:, :, :, num_channel]) * y_pred[:, :, :, num_channel])
-    return K.mean((true_pos + smooth) / (true_pos + alpha * false_neg + (1 - alpha) * false_pos + smooth))
-
-
-def tversky_bladder(y_true, y_pred, num_channel=2):
-    true_pos = K.sum(y_true[:, :, :, num_channel] * y_pred[:, :, :, num_channel])
-    false_neg = K.sum(y_true[:, :, :, num_channel] * (1 - y_pred[:, :, :, num_channel]))
-    false_pos = K.sum((1 - y_true[:, :, :, num_channel]) * y_pred[:, :, :, num_channel])
-    return K.mean((true_pos + smooth) / (true_pos + alpha * false_neg + (1 - alpha) * false_pos + smooth))
-
-
-def tversky_lungs(y_true, y_pred, num_channel=3):
-    true_pos = K.sum(y_true[:, :, :, num_channel] * y_pred[:, :, :, num_channel])
-    false_neg = K.sum(y_true[:, :, :, num_channel] * (1 - y_pred[:, :, :, num_channel]))
-    false_pos = K.sum((1 - y_true[:, :, :, num_channel]) * y_pred[:, :, :, num_channel])
-    return K.mean((true_pos + smooth) / (true_pos + alpha * false_neg + (1 - alpha) * false_pos + smooth))
-
-
-def tversky_kidneys(y_true, y_pred, num_channel=4):
-    true_pos = K.sum(y_true[:, :, :, num_channel] * y_pred[:, :, :, num_channel])
-    false_neg = K.sum(y_true[:, :, :, num_channel] * (1 - y_pred[:, :, :, num_channel]))
-    false_pos = K.sum((1 - y_true[:, :, :, num_channel]) * y_pred[:, :, :, num_channel])
-    return K.mean((true_pos + smooth) / (true_pos + alpha * false_neg + (1 - alpha) * false_pos + smooth))
-
-
-def tversky_bones(y_true, y_pred, num_channel=5):
-    true_pos = K.sum(y_true[:, :, :, num_channel] * y_pred[:, :, :, num_channel])
-    false_neg = K.sum(y_true[:, :, :, num_channel] * (1 - y_pred[:, :, :, num_channel]))
-    false_pos = K.sum((1 - y_true[:, :, :, num_channel]) * y_pred[:, :, :, num_channel])
-    return K.mean((true_pos + smooth) / (true_pos + alpha * false_neg + (1 - alpha) * false_pos + smooth))
-
-
 # 0 background
 # 1 liver
 # 2 bladder
@@ -88,12 +46,37 @@ lungs_w = 1
 kidneys_w = 1.55
 bones_w = 1
 weights_sum = liver_w + bladder_w + lungs_w + kidneys_w + bones_w
+organs_w = [liver_w, bladder_w, lungs_w, kidneys_w, bones_w]
+
+
+def tversky_organs(y_true, y_pred):
+    """Tversky index of every organ channel, computed with a single reduction over the batch"""
+    y_true = y_true[:, :, :, 1:]
+    y_pred = y_pred[:, :, :, 1:]
+    true_pos = K.sum(y_true * y_pred, axis=[0, 1, 2])
+    false_neg = K.sum(y_true, axis=[0, 1, 2]) - true_pos
+    false_pos = K.sum(y_pred, axis=[0, 1, 2]) - true_pos
+    return (true_pos + smooth) / (true_pos + alpha * false_neg + (1 - alpha) * false_pos + smooth)
+
+
+def make_tversky(num_channel, name):
+    """Tversky index of a single organ, as a slice of the fused tversky_organs reduction"""
+    def tversky(y_true, y_pred):
+        return tversky_organs(y_true, y_pred)[num_channel - 1]
+
+    tversky.__name__ = name
+    return tversky
+
+
+tversky_liver = make_tversky(1, 'tversky_liver')
+tversky_bladder = make_tversky(2, 'tversky_bladder')
+tversky_lungs = make_tversky(3, 'tversky_lungs')
+tversky_kidneys = make_tversky(4, 'tversky_kidneys')
+tversky_bones = make_tversky(5, 'tversky_bones')
 
 
 def tversky_index(y_true, y_pred):
-    return ((liver_w * tversky_liver(y_true, y_pred) + bladder_w * tversky_bladder(y_true, y_pred) +
-             lungs_w * tversky_lungs(y_true, y_pred) + kidneys_w * tversky_kidneys(y_true, y_pred) +
-             bones_w * tversky_bones(y_true, y_pred)) / weights_sum)
+    return K.sum(tversky_organs(y_true, y_pred) * organs_w) / weights_sum
 
 
 def foc_tversky_loss(y_true, y_pred):
@@ -103,40 +86,30 @@ def foc_tversky_loss(y_true, y_pred):
     return K.pow((1 - pt_2), gamma)
 
 
-def dice_background(y_true, y_pred, smooth=1, num_class=0):
-    intersection = K.sum(y_true[:, :, :, num_class] * y_pred[:, :, :, num_class])
-    union = K.sum(y_true[:, :, :, num_class]) + K.sum(y_pred[:, :, :, num_class])
-    return K.mean((2. * intersection + smooth) / (union + smooth))
+def dice_classes(y_true, y_pred, smooth=1):
+    """Dice score of every class channel, computed with a single reduction over the batch. The per-class metrics
+    below are slices of it: being the same subgraph on the same inputs, the graph optimizer computes it only once"""
+    intersection = K.sum(y_true * y_pred, axis=[0, 1, 2])
+    union = K.sum(y_true, axis=[0, 1, 2]) + K.sum(y_pred, axis=[0, 1, 2])
+    return (2. * intersection + smooth) / (union + smooth)
 
 
-def dice_liver(y_true, y_pred, smooth=1, num_class=1):
-    intersection = K.sum(y_true[:, :, :, num_class] * y_pred[:, :, :, num_class])
-    union = K.sum(y_true[:, :, :, num_class]) + K.sum(y_pred[:, :, :, num_class])
-    return K.mean((2. * intersection + smooth) / (union + smooth))
+def make_dice(num_class, name):
+    """Dice score of a single class, as a slice of the fused dice_classes reduction. The metric is named after name,
+    which is the key used in the custom_objects of load_model"""
+    def metric(y_true, y_pred, smooth=1):
+        return dice_classes(y_true, y_pred, smooth)[num_class]
 
+    metric.__name__ = name
+    return metric
 
-def dice_bladder(y_true, y_pred, smooth=1, num_class=2):
-    intersection = K.sum(y_true[:, :, :, num_class] * y_pred[:, :, :, num_class])
-    union = K.sum(y_true[:, :, :, num_class]) + K.sum(y_pred[:, :, :, num_class])
-    return K.mean((2. * intersection + smooth) / (union + smooth))
 
-
-def dice_lungs(y_true, y_pred, smooth=1, num_class=3):
-    intersection = K.sum(y_true[:, :, :, num_class] * y_pred[:, :, :, num_class])
-    union = K.sum(y_true[:, :, :, num_class]) + K.sum(y_pred[:, :, :, num_class])
-    return K.mean((2. * intersection + smooth) / (union + smooth))
-
-
-def dice_kidneys(y_true, y_pred, smooth=1, num_class=4):
-    intersection = K.sum(y_true[:, :, :, num_class] * y_pred[:, :, :, num_class])
-    union = K.sum(y_true[:, :, :, num_class]) + K.sum(y_pred[:, :, :, num_class])
-    return K.mean((2. * intersection + smooth) / (union + smooth))
-
-
-def dice_bones(y_true, y_pred, smooth=1, num_class=5):
-    intersection = K.sum(y_true[:, :, :, num_class] * y_pred[:, :, :, num_class])
-    union = K.sum(y_true[:, :, :, num_class]) + K.sum(y_pred[:, :, :, num_class])
-    return K.mean((2. * intersection + smooth) / (union + smooth))
+dice_background = make_dice(0, 'dice_background')
+dice_liver = make_dice(1, 'dice_liver')
+dice_bladder = make_dice(2, 'dice_bladder')
+dice_lungs = make_dice(3, 'dice_lungs')
+dice_kidneys = make_dice(4, 'dice_kidneys')
+dice_bones = make_dice(5, 'dice_bones')
 
 
 # 0 background
@@ -149,12 +122,12 @@ def dice_bones(y_true, y_pred, smooth=1, num_class=5):
 # Weights have been extracted by counting how many pixels of each organ were present in the whole dataset Weights are
 # not computed at runtime just for training time purposes. The evaluate.py script compute the exacts weights for the
 # evaluated dataset
+dice_w = [0.0, 0.23212333520332026, 0.04549370195613813, 0.37348887454707363, 0.05246318852416101,
+          0.2964308997693069]
+
+
 def dice(y_true, y_pred, smooth=1):
-    return ((0.23212333520332026 * dice_liver(y_true, y_pred) + 0.04549370195613813 * dice_bladder(y_true, y_pred)
-             + 0.37348887454707363 * dice_lungs(y_true, y_pred) + 0.05246318852416101 * dice_kidneys(y_true, y_pred)
-             + 0.2964308997693069 * dice_bones(y_true, y_pred)) / (0.23212333520332026 + 0.04549370195613813 +
-                                                                   0.37348887454707363 + 0.05246318852416101 +
-                                                                   0.2964308997693069))
+    return K.sum(dice_classes(y_true, y_pred, smooth) * dice_w) / sum(dice_w)
 
 
 def dice_loss(y_true, y_pred):